@@ -1,6 +1,6 @@
 """ Configure eups for LSST """
 
-import os, re, sys
+import optparse, os, re, sys
 import pdb
 import eups
 import eups.distrib.builder
@@ -12,8 +12,70 @@ except ImportError:
 
 #-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
 #
-# Allow "eups fetch" as an alias for "eups distrib install"
+# Allow "eups fetch" as an alias for "eups distrib install".  Several
+# products may be fetched at once:
+#    eups fetch [options] product[:version] product[:version] ...
+# As with "eups distrib install", "eups fetch product version" (two
+# arguments, neither containing ":") fetches a single product and version.
 #
+class FetchUsageError(Exception):
+    pass
+
+class FetchOptionParser(optparse.OptionParser):
+    """An OptionParser that raises FetchUsageError rather than exiting, so that
+    we can fall back to "eups distrib install" for options we don't handle"""
+
+    def error(self, msg):
+        raise FetchUsageError(msg)
+
+def parseFetchArgs(argv):
+    """Parse the arguments to a multi-target "eups fetch".
+
+    Return (opts, targets), or None if argv isn't a multi-target fetch
+    """
+    parser = FetchOptionParser(usage="""eups fetch [options] product[:version] ...
+       eups fetch [options] product [version]
+
+Versions are given as product:version when fetching more than one product;
+with exactly two arguments and no ":", the second is taken as the version.""")
+    parser.add_option("-r", "--repository", dest="root", action="append", default=[],
+                      help="the base URL of a package server (may be repeated)")
+    parser.add_option("-f", "--flavor", dest="flavor",
+                      help="the platform flavor to install for (must be the current flavor)")
+    parser.add_option("-O", "--option", dest="options", action="append", default=[],
+                      help="a NAME=VALUE option to pass to the distribution classes")
+    parser.add_option("--noclean", dest="noclean", action="store_true", default=False,
+                      help="don't clean up the build directories")
+    parser.add_option("-v", "--verbose", dest="verbose", action="count", default=0)
+
+    try:
+        opts, targets = parser.parse_args(argv)
+    except FetchUsageError:
+        return None
+
+    if len(targets) <= 2 and not filter(lambda t: ":" in t, targets):
+        return None                     # e.g. "eups fetch product version"
+
+    return opts, targets
+
+def fetchMany(Eups, opts, targets):
+    """Install several top-level products, sharing a single install plan"""
+
+    import os, lssteups                 # importing into startup.py isn't good enough
+
+    pkgroots = "|".join(opts.root) or os.environ.get("EUPS_PKGROOT")
+    if not pkgroots:
+        raise RuntimeError("No package servers given (-r) and EUPS_PKGROOT is not set")
+
+    options = {}
+    for opt in opts.options:
+        key, value = (opt.split("=", 1) + [True])[:2]
+        options[key] = value
+
+    session = lssteups.FetchSession(Eups, pkgroots, opts.flavor, options=options,
+                                    noclean=opts.noclean, verbosity=opts.verbose)
+    return session.run(map(lssteups.FetchSession.parseTarget, targets))
+
 def cmdHook(Eups, cmd, opts, args):
     """Called by eups to allow users to customize behaviour by defining it in EUPS_STARTUP
 
@@ -21,8 +83,20 @@ def cmdHook(Eups, cmd, opts, args):
     and sys.argv, which you may modify;  cmd == argv[1] if len(argv) > 1 else None
     """
 
+    import sys                          # importing into startup.py isn't good enough
+
     if cmd == "eups fetch":
-        argv[1:2] = ["distrib", "install"]
+        fetch = parseFetchArgs(args[2:])
+        if fetch:
+            import eups.distrib.server
+            try:
+                fetchMany(Eups, *fetch)
+            except (RuntimeError, EnvironmentError, eups.distrib.server.ServerError), e:
+                print >> sys.stderr, "eups fetch: %s" % e
+                sys.exit(1)
+            sys.exit(0)
+
+        args[1:2] = ["distrib", "install"]
 
 #-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
 
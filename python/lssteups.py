@@ -3,13 +3,374 @@
 #
 # various specializations for LSST (during DC2)
 #
-import sys, os, os.path, re, atexit, shutil
+import sys, os, os.path, re, atexit, shutil, time, urllib, urllib2
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import new as md5
+import stat, threading, tempfile
+import cPickle as pickle
 import eups.distrib.server as eupsServer
 import eups.distrib        as eupsDistrib
 import eups.lock
 
 defaultPackageBase = "http://dev.lsstcorp.org/pkgs/prod"
 
+class ManifestIndex(object):
+    """an on-disk index of the manifests available in a server's manifest
+    directory.
+
+    Listing the manifest directory and matching every entry against
+    MANIFEST_FILE_RE is expensive when the server holds many manifests.  This
+    class keeps the parsed (product, version, flavor) entries in a local
+    file, keyed by product name, and refreshes it only when it has gone
+    stale.  A refresh first tries the server's change log (if one is
+    configured), then a conditional request for the directory listing
+    (using the ETag and Last-Modified values from the previous listing);
+    only when both fail is a full listing downloaded and parsed.
+    """
+
+    _hrefRe = re.compile(r'href\s*=\s*["\']?([^"\'\s>]+)', re.IGNORECASE)
+
+    def __init__(self, dirUrl, fileRe, cacheFile, ttl=300, changesUrl=None,
+                 verbosity=0, log=sys.stderr):
+        """create the index
+        @param dirUrl      the URL (or local path) of the manifest directory
+        @param fileRe      the regular expression (string or compiled) that
+                             manifest file names must match.  It must
+                             provide product, version, and flavor groups.
+        @param cacheFile   the local file to store the index in
+        @param ttl         the number of seconds the index is considered
+                             fresh after it was last checked against the
+                             server
+        @param changesUrl  the URL of a server-published change log; if None,
+                             only the directory listing is used.
+        """
+        self.dirUrl = dirUrl
+        if isinstance(fileRe, basestring):
+            fileRe = re.compile(fileRe)
+        self.fileRe = fileRe
+        self.cacheFile = cacheFile
+        self.ttl = ttl
+        self.changesUrl = changesUrl
+        self.verbose = verbosity
+        self.log = log
+        self._load()
+
+    def _reset(self):
+        self.etag = None
+        self.modified = None
+        self.checked = 0
+        self.changesOffset = None
+        self.products = {}
+
+    def _load(self):
+        self._reset()
+        if not os.path.exists(self.cacheFile):
+            return
+
+        # unpickling can run arbitrary code, so only trust our own files
+        if os.stat(self.cacheFile).st_uid != os.geteuid():
+            if self.verbose > 0:
+                print >> self.log, "Ignoring manifest index %s:" % \
+                    self.cacheFile, "not owned by me"
+            return
+        try:
+            fd = open(self.cacheFile, 'rb')
+            try:
+                data = pickle.load(fd)
+            finally:
+                fd.close()
+        except Exception, e:
+            if self.verbose > 0:
+                print >> self.log, "Ignoring unreadable manifest index %s: %s" \
+                    % (self.cacheFile, e)
+            return
+
+        # entries parsed with a different pattern can't be trusted
+        if data.get("url") != self.dirUrl or \
+           data.get("pattern") != self.fileRe.pattern:
+            return
+        self.etag = data.get("etag")
+        self.modified = data.get("modified")
+        self.checked = data.get("checked", 0)
+        self.changesOffset = data.get("changesOffset")
+        self.products = data.get("products", {})
+
+    def _save(self):
+        data = { "url": self.dirUrl, "pattern": self.fileRe.pattern,
+                 "etag": self.etag,
+                 "modified": self.modified, "checked": self.checked,
+                 "changesOffset": self.changesOffset,
+                 "products": self.products }
+
+        # write to a temporary file and rename it into place so that
+        # concurrent readers never see a partially written index
+        cacheDir = os.path.dirname(self.cacheFile)
+        try:
+            if cacheDir and not os.path.exists(cacheDir):
+                os.makedirs(cacheDir)
+            tmpfile = "%s.%d" % (self.cacheFile, os.getpid())
+            fd = open(tmpfile, 'wb')
+            try:
+                pickle.dump(data, fd, pickle.HIGHEST_PROTOCOL)
+            finally:
+                fd.close()
+            os.rename(tmpfile, self.cacheFile)
+        except (IOError, OSError), e:
+            if self.verbose > 0:
+                print >> self.log, "Unable to save manifest index %s: %s" % \
+                    (self.cacheFile, e)
+
+    def isFresh(self):
+        """return True if the index was checked against the server recently
+        enough that it can be used without a network round trip.
+        """
+        return self.checked > 0 and time.time() - self.checked < self.ttl
+
+    def lookup(self, product=None, version=None, flavor=None):
+        """return a list of (product, version, flavor) tuples for the
+        manifests that match the given constraints.  Refresh the index
+        first if it is stale.
+        @param product     the product name to restrict the list to; if None,
+                             all products are returned.
+        @param version     the version to restrict the list to
+        @param flavor      the flavor to restrict the list to; manifests with
+                             no flavor or the "generic" flavor always match.
+        """
+        if not self.isFresh():
+            self.refresh()
+
+        if product is not None:
+            prods = [ product ]
+        else:
+            prods = self.products.keys()
+            prods.sort()
+
+        out = []
+        for prod in prods:
+            entries = self.products.get(prod, {}).keys()
+            entries.sort()
+            for vers, flav in entries:
+                if version is not None and vers != version:
+                    continue
+                if flavor is not None and flav not in (flavor, None, "generic"):
+                    continue
+                out.append( (prod, vers, flav) )
+        return out
+
+    def refresh(self, force=False):
+        """bring the index up to date with the server.
+        @param force    if True, ignore any cached validators and download
+                          the full directory listing.
+        """
+        if force:
+            self._reset()
+
+        updated = False
+        if self.changesUrl and self.changesOffset is not None:
+            updated = self._applyChanges()
+        if not updated:
+            self._relist()
+
+        self.checked = time.time()
+        self._save()
+
+    def _addEntry(self, filename):
+        mat = self.fileRe.match(filename)
+        if not mat:
+            return
+        prod = mat.group("product")
+        self.products.setdefault(prod, {})[(mat.group("version"),
+                                            mat.group("flavor"))] = filename
+
+    def _removeEntry(self, filename):
+        mat = self.fileRe.match(filename)
+        if not mat:
+            return
+        prod = mat.group("product")
+        entries = self.products.get(prod)
+        if entries is None:
+            return
+        entries.pop((mat.group("version"), mat.group("flavor")), None)
+        if not entries:
+            del self.products[prod]
+
+    def _isLocal(self, url):
+        return url.startswith("file:") or "://" not in url
+
+    def _localPath(self, url):
+        if url.startswith("file:"):
+            return urllib.url2pathname(url[len("file:"):])
+        return url
+
+    def _relist(self):
+        """refresh from the directory listing, using a conditional request
+        when possible.
+        """
+        # note where the change log ends before listing: a manifest added
+        # while we list will then be replayed from the log next time
+        # (which is harmless) rather than missed.
+        offset = None
+        if self.changesUrl:
+            offset = self._changesLength()
+
+        self._list()
+        self.changesOffset = offset
+
+    def _list(self):
+        if self._isLocal(self.dirUrl):
+            path = self._localPath(self.dirUrl)
+            modified = os.stat(path).st_mtime
+            if self.products and modified == self.modified:
+                return
+            self.products = {}
+            for name in os.listdir(path):
+                self._addEntry(name)
+            self.modified = modified
+            return
+
+        req = urllib2.Request(self.dirUrl)
+        if self.products:
+            if self.etag:
+                req.add_header("If-None-Match", self.etag)
+            if self.modified:
+                req.add_header("If-Modified-Since", self.modified)
+        try:
+            resp = urllib2.urlopen(req)
+        except urllib2.HTTPError, e:
+            if e.code == 304:
+                if self.verbose > 1:
+                    print >> self.log, "Manifest index is up to date"
+                return
+            raise eupsServer.ServerError("Failed to list %s: %s" %
+                                         (self.dirUrl, e))
+        except urllib2.URLError, e:
+            raise eupsServer.ServerError("Failed to list %s: %s" %
+                                         (self.dirUrl, e))
+
+        try:
+            listing = resp.read()
+            self.etag = resp.info().getheader("ETag")
+            self.modified = resp.info().getheader("Last-Modified")
+        finally:
+            resp.close()
+
+        if self.verbose > 1:
+            print >> self.log, "Rebuilding manifest index from", self.dirUrl
+        self.products = {}
+        for href in self._hrefRe.findall(listing):
+            self._addEntry(urllib.unquote(href.rstrip('/').split('/')[-1]))
+
+    def _readChanges(self, offset):
+        """return the change log contents starting at the given byte offset,
+        or None if the log is unavailable.
+        """
+        if self._isLocal(self.changesUrl):
+            try:
+                fd = open(self._localPath(self.changesUrl))
+                try:
+                    fd.seek(0, 2)
+                    if fd.tell() < offset:
+                        return None
+                    fd.seek(offset)
+                    return fd.read()
+                finally:
+                    fd.close()
+            except IOError:
+                return None
+
+        req = urllib2.Request(self.changesUrl)
+        if offset > 0:
+            req.add_header("Range", "bytes=%d-" % offset)
+        try:
+            resp = urllib2.urlopen(req)
+        except urllib2.HTTPError, e:
+            if e.code != 416:
+                return None
+
+            # the offset is at or beyond the end of the log: either nothing
+            # was appended, or the log was truncated or rotated.
+            length = None
+            mat = re.match(r"bytes\s+\*/(\d+)",
+                           e.info().getheader("Content-Range") or "")
+            if mat:
+                length = int(mat.group(1))
+            else:
+                length = self._changesLength()
+            if length is None or length < offset:
+                return None
+            return ""
+        except urllib2.URLError:
+            return None
+
+        try:
+            data = resp.read()
+            if resp.code != 206:
+                # the server ignored the range request
+                if len(data) < offset:
+                    return None
+                data = data[offset:]
+        finally:
+            resp.close()
+        return data
+
+    def _changesLength(self):
+        """return the current length of the change log in bytes, or None if
+        it is unavailable.
+        """
+        if self._isLocal(self.changesUrl):
+            try:
+                return os.path.getsize(self._localPath(self.changesUrl))
+            except OSError:
+                return None
+
+        req = urllib2.Request(self.changesUrl)
+        req.get_method = lambda: "HEAD"
+        try:
+            resp = urllib2.urlopen(req)
+        except urllib2.URLError:
+            return None
+        try:
+            length = resp.info().getheader("Content-Length")
+        finally:
+            resp.close()
+
+        if length is None:
+            return None
+        try:
+            return int(length)
+        except ValueError:
+            return None
+
+    def _applyChanges(self):
+        """update the index from the change log.  Each line of the log names
+        a manifest file prefixed by "+" (added) or "-" (removed).  Return
+        False if the log could not be used.
+        """
+        data = self._readChanges(self.changesOffset)
+        if data is None:
+            return False
+
+        # only consume complete lines; a partial trailing line will be
+        # read again next time.
+        end = data.rfind("\n") + 1
+        for line in data[:end].splitlines():
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            op, filename = line[0], line[1:].strip()
+            if op == '+':
+                self._addEntry(filename)
+            elif op == '-':
+                self._removeEntry(filename)
+        self.changesOffset += end
+
+        if self.verbose > 1:
+            print >> self.log, "Applied %d bytes of manifest changes" % end
+        return True
+
+
 class DistribServer(eupsServer.ConfigurableDistribServer):
     """a class that encapsulates the communication with a package server.
 
@@ -21,7 +382,8 @@ class DistribServer(eupsServer.ConfigurableDistribServer):
     """
 
     validConfigKeys = eupsServer.ConfigurableDistribServer.validConfigKeys + \
-      [ "EXTERNAL_TABLE_URL", "EXTERNAL_TABLE_FLAVOR_URL", "EXTERNAL_DIST_URL" ]
+      [ "EXTERNAL_TABLE_URL", "EXTERNAL_TABLE_FLAVOR_URL", "EXTERNAL_DIST_URL",
+        "MANIFEST_CHANGES_URL", "MANIFEST_INDEX_DIR", "MANIFEST_INDEX_TTL" ]
 
     def _initConfig_(self):
         eupsServer.ConfigurableDistribServer._initConfig_(self)
@@ -73,11 +435,65 @@ class DistribServer(eupsServer.ConfigurableDistribServer):
             self.config['MANIFEST_FILE_RE'] = \
                 r"^(?P<product>[^\-\s]+)(-(?P<version>\S+))?" + \
                 r"(@(?P<flavor>[^\-\s]+))?.manifest$"
+        if not self.config.has_key('MANIFEST_INDEX_DIR'):
+            # without a home directory there is no private place to keep
+            # the index, so it is disabled (an empty value)
+            self.config['MANIFEST_INDEX_DIR'] = ""
+            if os.environ.get("HOME"):
+                self.config['MANIFEST_INDEX_DIR'] = \
+                    os.path.join(os.environ["HOME"], ".eups", "lssteups")
+        if not self.config.has_key('MANIFEST_INDEX_TTL'):
+            self.config['MANIFEST_INDEX_TTL'] = "300"
 
         if not self.config.has_key('DISTRIB_CLASS'):
             self.setConfigProperty('DISTRIB_CLASS',
                                    'pacman: lssteups.DistribPacman')
 
+    def _getManifestIndex(self, flavor=None):
+        """return the ManifestIndex for this server's manifest directory
+        (for the given flavor), creating it on first use.
+        """
+        props = { "base": self.base, "flavor": flavor }
+        dirUrl = self.config['MANIFEST_DIR_URL'] % props
+
+        if not hasattr(self, "_manifestIndexes"):
+            self._manifestIndexes = {}
+        if not self._manifestIndexes.has_key(dirUrl):
+            changesUrl = self.config.get('MANIFEST_CHANGES_URL')
+            if changesUrl:
+                changesUrl = changesUrl % props
+            cacheFile = os.path.join(self.config['MANIFEST_INDEX_DIR'],
+                                     "manifests-%s.idx" %
+                                     md5(dirUrl).hexdigest())
+            self._manifestIndexes[dirUrl] = \
+                ManifestIndex(dirUrl, self.config['MANIFEST_FILE_RE'],
+                              cacheFile, int(self.config['MANIFEST_INDEX_TTL']),
+                              changesUrl, self.verbose, self.log)
+        return self._manifestIndexes[dirUrl]
+
+    def listAvailableProducts(self, product=None, version=None, flavor=None,
+                              tag=None, noaction=False):
+        """return a list of available products on the server.  Each item 
+        in the list is a tuple of the form, (product, version, flavor).
+
+        Unless a tag is given (or MANIFEST_INDEX_DIR is empty), the list is
+        answered from a local index of the manifest directory (see 
+        ManifestIndex) which is only refreshed from the server once it has 
+        gone stale.
+
+        @param product     the name of the product to restrict the list to.
+                             If None, all products are returned.
+        @param version     the version to restrict the list to.
+        @param flavor      the platform flavor to restrict the list to.
+        @param tag         return only the products tagged with this tag
+        @param noaction    if True, simulate the retrieval
+        """
+        if tag is not None or noaction or not self.config['MANIFEST_INDEX_DIR']:
+            return eupsServer.ConfigurableDistribServer.listAvailableProducts(
+                self, product, version, flavor, tag, noaction)
+
+        return self._getManifestIndex(flavor).lookup(product, version, flavor)
+
     def getFileForProduct(self, path, product, version, flavor, 
                           ftype=None, filename=None, noaction=False):
         """return a copy of a file with a given path on the server associated
@@ -132,13 +548,255 @@ class DistribServer(eupsServer.ConfigurableDistribServer):
         """
         try:
             # search for a version specialized for the exact version
-            return eupsServer.ConfigurableDistribServer.getTableFile(product,
-                                          version, flavor, filename, noaction)
+            return eupsServer.ConfigurableDistribServer.getTableFile(self, 
+                                 product, version, flavor, filename, noaction)
         except eupsServer.RemoteFileNotFound, ex:
             # try a generic one for the release (before +/- in version)
             release = re.sub(r'[+\-].+$', '', version);
-            return eupsServer.ConfigurableDistribServer.getTableFile(product,
-                                          release, flavor, filename, noaction)
+            return eupsServer.ConfigurableDistribServer.getTableFile(self, 
+                                 product, release, flavor, filename, noaction)
+
+
+class GroupPermFinalizer(object):
+    """a class that gives a group ownership of, and read/write access to,
+    every file under a directory tree.
+
+    The tree is walked by a pool of threads (one directory at a time per
+    thread), which pays off on network filesystems where each stat is a
+    round trip.  Entries that already have the right group and mode are
+    only stat-ed; the changes needed within a directory are collected and
+    applied together.  Symbolic links are left alone, as are files not 
+    owned by the current user (unless running as root).
+
+    The walk can also be run repeatedly in the background (see start())
+    while a product is being installed so that most of the work is done by
+    the time the install finishes.
+    """
+
+    def __init__(self, root, gid, nthreads=8, interval=30,
+                 verbosity=0, log=sys.stderr):
+        """
+        @param root       the root of the directory tree to finalize
+        @param gid        the numeric ID of the group to give access to
+                            (see getGid())
+        @param nthreads   the number of threads to walk the tree with
+        @param interval   the number of seconds to wait between passes
+                            when running in the background
+        """
+        self.root = root
+        self.gid = gid
+        self.nthreads = max(int(nthreads), 1)
+        self.interval = interval
+        self.verbose = verbosity
+        self.log = log
+        self.uid = os.geteuid()
+
+        # counts for the most recent pass (see run())
+        self.nseen = 0
+        self.nskipped = 0
+        self.ntouched = 0
+        self.elapsed = 0.0
+
+        # the number of entries changed by earlier (background) passes
+        self.nearlier = 0
+
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._bgthread = None
+
+    # @staticmethod   # requires python 2.4
+    def getGid(group):
+        """return the numeric ID for a group given by name or number.  A 
+        RuntimeError is raised if the group does not exist.
+        """
+        import grp
+        try:
+            return int(group)
+        except ValueError:
+            pass
+        try:
+            return grp.getgrnam(group).gr_gid
+        except KeyError:
+            raise RuntimeError("%s: unknown group" % group)
+
+    getGid = staticmethod(getGid)
+
+    def _wantedMode(self, st):
+        mode = stat.S_IMODE(st.st_mode) | stat.S_IRGRP | stat.S_IWGRP
+        if stat.S_ISDIR(st.st_mode):
+            mode |= stat.S_IXGRP | stat.S_ISGID
+        elif st.st_mode & stat.S_IXUSR:
+            mode |= stat.S_IXGRP
+        return mode
+
+    def _check(self, path, st, fixes):
+        """add the changes needed for a path to the fixes list.  Return 
+        True if the path had to be skipped because we don't own it.
+        """
+        if stat.S_ISLNK(st.st_mode):
+            return False
+        if self.uid != 0 and st.st_uid != self.uid:
+            if self.verbose > 1:
+                print >> self.log, "Skipping %s: not owned by me" % path
+            return True
+        mode = self._wantedMode(st)
+        chgrp = st.st_gid != self.gid
+        if chgrp or mode != stat.S_IMODE(st.st_mode):
+            fixes.append( (path, chgrp, mode) )
+        return False
+
+    def _apply(self, fixes):
+        touched = 0
+        for path, chgrp, mode in fixes:
+            try:
+                # chgrp first: it may clear the setgid bit
+                if chgrp:
+                    os.lchown(path, -1, self.gid)
+                os.chmod(path, mode)
+                touched += 1
+            except OSError, e:
+                if self.verbose > 0:
+                    print >> self.log, "Failed to set group permissions on", \
+                        "%s: %s" % (path, e)
+        return touched
+
+    def _worker(self, dirs, errors):
+        while True:
+            dir = dirs.get()
+            if dir is None:
+                dirs.task_done()
+                return
+            try:
+                fixes = []
+                seen = 0
+                skipped = 0
+                try:
+                    names = os.listdir(dir)
+                except OSError, e:
+                    names = []
+                    if self.verbose > 0:
+                        print >> self.log, "Unable to list %s: %s" % (dir, e)
+                for name in names:
+                    path = os.path.join(dir, name)
+                    try:
+                        st = os.lstat(path)
+                    except OSError:
+                        continue    # removed from under us
+                    seen += 1
+                    if stat.S_ISDIR(st.st_mode):
+                        dirs.put(path)
+                    if self._check(path, st, fixes):
+                        skipped += 1
+                touched = self._apply(fixes)
+
+                self._lock.acquire()
+                try:
+                    self.nseen += seen
+                    self.nskipped += skipped
+                    self.ntouched += touched
+                finally:
+                    self._lock.release()
+            except Exception, e:
+                errors.append(e)
+            dirs.task_done()
+
+    def run(self):
+        """make one pass over the tree.  Return the number of entries
+        whose group or mode was changed.  Afterward, nseen, nskipped,
+        ntouched and elapsed describe this pass alone: the number of 
+        entries examined, left alone because we don't own them, and 
+        changed, and the time the pass took.
+        """
+        import Queue
+        self.nearlier += self.ntouched
+        self.nseen = self.nskipped = self.ntouched = 0
+        self.elapsed = 0.0
+        if not os.path.exists(self.root):
+            return 0
+
+        t0 = time.time()
+        fixes = []
+        st = os.lstat(self.root)
+        self.nseen = 1
+        if self._check(self.root, st, fixes):
+            self.nskipped += 1
+        self.ntouched += self._apply(fixes)
+
+        if stat.S_ISDIR(st.st_mode):
+            dirs = Queue.Queue()
+            errors = []
+            dirs.put(self.root)
+            threads = []
+            for i in xrange(self.nthreads):
+                t = threading.Thread(target=self._worker,
+                                     args=(dirs, errors))
+                t.setDaemon(True)
+                t.start()
+                threads.append(t)
+
+            # wait for the walk to drain the queue, then stop the workers
+            dirs.join()
+            for t in threads:
+                dirs.put(None)
+            for t in threads:
+                t.join()
+            if errors:
+                raise errors[0]
+
+        self.elapsed = time.time() - t0
+        return self.ntouched
+
+    def _runInBackground(self):
+        while not self._stop.isSet():
+            try:
+                self.run()
+            except Exception, e:
+                if self.verbose > 0:
+                    print >> self.log, "Background permission update failed:", e
+            self._stop.wait(self.interval)
+
+    def start(self):
+        """start making passes over the tree in a background thread until
+        finish() is called.
+        """
+        if self._bgthread is not None:
+            return
+        self._stop.clear()
+        self._bgthread = threading.Thread(target=self._runInBackground)
+        self._bgthread.setDaemon(True)
+        self._bgthread.start()
+
+    def stop(self):
+        """stop any background passes without making a final one"""
+        if self._bgthread is not None:
+            self._stop.set()
+            self._bgthread.join()
+            self._bgthread = None
+
+    def finish(self):
+        """stop any background passes, make a final pass over the tree, and
+        report the final pass's throughput (if verbose).  Return the total
+        number of entries changed, including by background passes.
+        """
+        self.stop()
+        self.run()
+
+        if self.verbose > 0:
+            rate = 0.0
+            if self.elapsed > 0:
+                rate = self.ntouched / self.elapsed
+            print >> self.log, "Set group permissions on %d of %d files" % \
+                (self.ntouched, self.nseen), \
+                "under %s in %.1f s (%.0f files/s)" % \
+                (self.root, self.elapsed, rate)
+            if self.nearlier:
+                print >> self.log, "(%d more were set while installing)" % \
+                    self.nearlier
+            if self.nskipped:
+                print >> self.log, "Skipped %d files under %s not owned by me" \
+                    % (self.nskipped, self.root)
+
+        return self.nearlier + self.ntouched
 
 
 class BuildDistrib(eupsDistrib.DefaultDistrib):
@@ -157,6 +815,27 @@ class BuildDistrib(eupsDistrib.DefaultDistrib):
         self.nobuild = self.options.get("nobuild", False)
         self.noclean = self.options.get("noclean", False)
 
+        # group permissions on installed trees are set by a multi-threaded
+        # walk (see GroupPermFinalizer) when a group is given
+        self.groupowner = self.getOption('groupowner', None)
+        self.groupGid = None
+        if self.groupowner:
+            self.groupGid = GroupPermFinalizer.getGid(self.groupowner)
+        self.permThreads = int(self.getOption('permThreads', 8))
+        self.permsDuringBuild = self.options.get("permsDuringBuild", False)
+
+        # if set, products are built below this (RAM-backed or node-local)
+        # directory whenever it has room for them; see _chooseBuildDir()
+        self.scratchDir = self.getOption('scratchDir', None)
+        self.scratchReserve = int(self.getOption('scratchReserveMB', 512)) << 20
+        self.scratchFactor = float(self.getOption('scratchFactor', 10))
+        # without a home directory, no build history is kept
+        defSizeFile = None
+        if os.environ.get("HOME"):
+            defSizeFile = os.path.join(os.environ["HOME"], ".eups", 
+                                       "lssteups", "buildsizes")
+        self.buildSizeFile = self.getOption('buildSizeFile', defSizeFile)
+
         # this will be used to determine if the manifestToFile option was 
         # not used in conjunction with -j 
         self._outmanfile = [ self.options.get("manifestToFile", None), None ]
@@ -184,6 +863,14 @@ class BuildDistrib(eupsDistrib.DefaultDistrib):
         """
         if not buildDir:
             buildDir = self.getOption('buildDir', 'EupsBuildDir')
+
+        # the build may be moved to a private directory in the scratch 
+        # area; logs still end up here
+        logDir = buildDir
+        need = None
+        if self.scratchDir and not self.nobuild:
+            buildDir, need = self._chooseBuildDir(logDir, product, version)
+
         if self.verbose > 0:
             print >> self.log, "Building in", buildDir
 
@@ -196,21 +883,32 @@ class BuildDistrib(eupsDistrib.DefaultDistrib):
             raise RuntimeError("Unable to find a stack I can write to among $EUPS_PATH")
         installDir = os.path.join(installRoot, self.Eups.flavor, installDir)
 
-        if not os.path.isdir(buildDir):
-            try:
-                os.makedirs(buildDir)
-            except:
-                raise RuntimeError("%s: unable to create build directory" % buildDir)
+        for dir in [buildDir, logDir]:
+            if not os.path.isdir(dir):
+                try:
+                    os.makedirs(dir)
+                except:
+                    raise RuntimeError("%s: unable to create build directory" % dir)
 
         # fetch the package from the server;  by default, the URL will be 
         # of the form pkgroot/location.  With this convention, the location
         # will include the product, version, and flavor components explicitly.
         if not self.nobuild:
+            # with no build history, the size of the tarball is needed to 
+            # estimate whether the build fits into the scratch area, so 
+            # download it to disk first.
+            fetchDir = buildDir
+            if buildDir != logDir and need is None:
+                fetchDir = logDir
+
             distFile = os.path.basename(location)
             self.distServer.getFileForProduct(location, product, version, 
                                               self.Eups.flavor, ftype="DIST",
-                                              filename=os.path.join(buildDir, 
+                                              filename=os.path.join(fetchDir, 
                                                                     distFile))
+            if fetchDir != buildDir:
+                buildDir = self._confirmScratchBuildDir(buildDir, logDir, 
+                                                        distFile)
 
             # catch the setup commands to a file in the build directory
             # make sure every setup line is includes the -j option
@@ -227,6 +925,12 @@ class BuildDistrib(eupsDistrib.DefaultDistrib):
                 finally:
                     fd.close()
 
+            # optionally fix up group permissions while the build is
+            # still writing into the install directory
+            finalizer = self._getPermFinalizer(installDir)
+            if finalizer and self.permsDuringBuild and not self.Eups.noaction:
+                finalizer.start()
+
             lockReleased = False
             try:
               # need to release an exclusive lock to allow the script 
@@ -247,9 +951,18 @@ class BuildDistrib(eupsDistrib.DefaultDistrib):
             finally:
               if lockReleased:
                   self._reestablishLock(productRoot)
+              if finalizer:
+                  finalizer.stop()
+              if buildDir != logDir and not self.Eups.noaction:
+                  self._saveBuildLogs(buildDir, logDir)
+                  self._recordBuildSize(product, self._dirSize(buildDir))
 
             if os.path.exists(installDir):
-                self.setGroupPerms(installDir)
+                if finalizer:
+                    if not self.Eups.noaction:
+                        finalizer.finish()
+                else:
+                    self.setGroupPerms(installDir)
 
         if not self.noclean:
             try:
@@ -259,6 +972,170 @@ class BuildDistrib(eupsDistrib.DefaultDistrib):
             except OSError, e:
                 raise RuntimeError("Failed to clean up build dir, " + buildDir)
 
+            # a scratch build directory is private to this build
+            if buildDir != logDir:
+                try:
+                    os.rmdir(buildDir)
+                except OSError:
+                    pass
+
+    def _scratchFree(self):
+        """return the number of bytes available for building in the scratch
+        area, less the configured reserve.
+        """
+        try:
+            st = os.statvfs(self.scratchDir)
+        except OSError:
+            return 0
+        return st.f_bavail * st.f_frsize - self.scratchReserve
+
+    def _makeScratchBuildDir(self):
+        """create a new build directory in the scratch area, private to 
+        this build (and to this user: mkdtemp creates it with mode 0700), 
+        and return its path.  Return None if it can't be created.
+        """
+        try:
+            return tempfile.mkdtemp(prefix="EupsBuildDir-", dir=self.scratchDir)
+        except (IOError, OSError), e:
+            if self.verbose > 0:
+                print >> self.log, "Unable to create a build directory in", \
+                    "%s: %s" % (self.scratchDir, e)
+            return None
+
+    def _chooseBuildDir(self, buildDir, product, version):
+        """decide whether to build a product in the scratch area.  Return
+        the build directory to use and the estimated space the build needs
+        in bytes (None if it is not known yet).
+        @param buildDir    the (disk) build directory to use if the scratch
+                             area does not have room
+        """
+        need = self._loadBuildSizes().get(product)
+        free = self._scratchFree()
+        if free <= 0 or (need is not None and need > free):
+            if self.verbose > 0:
+                print >> self.log, "Not enough room in %s to build %s %s;" % \
+                    (self.scratchDir, product, version), "building on disk"
+            return buildDir, need
+
+        scratch = self._makeScratchBuildDir()
+        if scratch is None:
+            return buildDir, need
+        return scratch, need
+
+    def _confirmScratchBuildDir(self, buildDir, diskBuildDir, distFile):
+        """check that the scratch area has room for a build whose size is
+        estimated from its distribution file, already downloaded into the 
+        disk build directory.  If it does, move the file into the scratch 
+        build directory and return that directory; otherwise, return the 
+        disk build directory.
+        """
+        path = os.path.join(diskBuildDir, distFile)
+        if not os.path.exists(path):
+            # e.g. noaction
+            return buildDir
+        need = os.path.getsize(path) * self.scratchFactor
+        if need > self._scratchFree():
+            if self.verbose > 0:
+                print >> self.log, "Not enough room in %s to build %s;" % \
+                    (self.scratchDir, distFile), "building on disk"
+            try:
+                os.rmdir(buildDir)
+            except OSError:
+                pass
+            return diskBuildDir
+
+        shutil.move(path, os.path.join(buildDir, distFile))
+        return buildDir
+
+    def _dirSize(self, path):
+        size = 0
+        for dir, subdirs, files in os.walk(path):
+            for name in files:
+                try:
+                    size += os.lstat(os.path.join(dir, name)).st_blocks * 512
+                except OSError:
+                    pass
+        return size
+
+    def _loadBuildSizes(self):
+        """return the recorded build sizes in bytes, keyed by product.  
+        Malformed lines are ignored, and an unreadable file is treated as
+        empty.
+        """
+        out = {}
+        if not self.buildSizeFile or not os.path.exists(self.buildSizeFile):
+            return out
+
+        try:
+            fd = open(self.buildSizeFile)
+            try:
+                for line in fd:
+                    fields = line.split()
+                    if len(fields) != 2:
+                        continue
+                    try:
+                        out[fields[0]] = int(fields[1])
+                    except ValueError:
+                        pass
+            finally:
+                fd.close()
+        except IOError, e:
+            if self.verbose > 0:
+                print >> self.log, "Ignoring unreadable build size file", \
+                    "%s: %s" % (self.buildSizeFile, e)
+        return out
+
+    def _recordBuildSize(self, product, size):
+        if size <= 0 or not self.buildSizeFile:
+            return
+        # keep the largest size seen so that a failed (partial) build
+        # doesn't lead to an underestimate next time
+        sizes = self._loadBuildSizes()
+        sizes[product] = max(size, sizes.get(product, 0))
+        try:
+            dir = os.path.dirname(self.buildSizeFile)
+            if dir and not os.path.exists(dir):
+                os.makedirs(dir)
+            # write to a temporary file and rename it into place so that
+            # concurrent installs never see a partially written file
+            tmpfile = "%s.%d" % (self.buildSizeFile, os.getpid())
+            fd = open(tmpfile, 'w')
+            try:
+                for prod in sorted(sizes.keys()):
+                    print >> fd, prod, sizes[prod]
+            finally:
+                fd.close()
+            os.rename(tmpfile, self.buildSizeFile)
+        except (IOError, OSError), e:
+            if self.verbose > 0:
+                print >> self.log, "Unable to record build size:", e
+
+    def _saveBuildLogs(self, buildDir, logDir):
+        """copy the build logs from a scratch build directory into the 
+        (shared) log directory, keeping their relative paths.
+        """
+        for dir, subdirs, files in os.walk(buildDir):
+            if "build.log" not in files:
+                continue
+            dest = os.path.join(logDir, dir[len(buildDir):].lstrip(os.sep))
+            try:
+                if not os.path.isdir(dest):
+                    os.makedirs(dest)
+                shutil.copy(os.path.join(dir, "build.log"), dest)
+            except (IOError, OSError), e:
+                print >> self.log, "Warning: failed to save build log", \
+                    "from %s: %s" % (dir, e)
+
+    def _getPermFinalizer(self, installDir):
+        """return a GroupPermFinalizer for an install directory, or None if
+        no group owner has been configured.
+        """
+        if self.groupGid is None:
+            return None
+        return GroupPermFinalizer(installDir, self.groupGid,
+                                  self.permThreads, verbosity=self.verbose,
+                                  log=self.log)
+
     def _releaseLock(self, productRoot):
         import pwd
         who = pwd.getpwuid(os.geteuid())[0]
@@ -597,3 +1474,178 @@ class BuildDistrib(eupsDistrib.DefaultDistrib):
                 # set group owner ship and permissions, if desired
                 self.setGroupPerms(dir)
 
+
+class FetchSession(object):
+    """a class that installs several top-level products in one session.
+
+    The manifests of all the targets are read up front and merged into a
+    single install plan in which each product appears once.  If two
+    targets require different versions of the same product, the conflict
+    is reported before anything is installed.  The plan is then installed
+    in order, dependencies first, straight from the manifests already
+    loaded, while holding the stack lock for the whole session; products
+    that are already installed are skipped.
+    """
+
+    def __init__(self, Eups, pkgroots, flavor=None, options=None,
+                 noclean=False, verbosity=0, log=sys.stderr):
+        """
+        @param Eups       the Eups instance to install into
+        @param pkgroots   the package server base URLs, separated by "|"
+        @param flavor     the platform flavor to install for.  Products are
+                            always installed for the flavor of Eups, so
+                            any other value is rejected.
+        @param options    a dictionary of options passed on to the Distrib
+                            classes (e.g. buildDir)
+        @param noclean    if True, don't clean up build directories
+        """
+        self.Eups = Eups
+        if not flavor:
+            flavor = Eups.flavor
+        if flavor != Eups.flavor:
+            # the Distrib classes (e.g. BuildDistrib) install under the 
+            # flavor of Eups
+            raise RuntimeError("Can only fetch for the current flavor, %s (not %s)"
+                               % (Eups.flavor, flavor))
+        self.flavor = flavor
+        self.options = options or {}
+        if noclean:
+            self.options["noclean"] = True
+        self.verbose = verbosity
+        self.log = log
+
+        self.repos = eupsDistrib.Repositories(pkgroots, options=self.options,
+                                              eupsenv=Eups, installFlavor=flavor,
+                                              verbosity=verbosity, log=log)
+
+    def parseTarget(target):
+        """split a target of the form product[:version] into a
+        (product, version) tuple; version is None if not given.
+        """
+        if ':' in target:
+            product, version = target.split(':', 1)
+            return (product, version or None)
+        return (target, None)
+
+    parseTarget = staticmethod(parseTarget)
+
+    def plan(self, targets):
+        """return the merged install plan for a list of targets as a list 
+        of (pkgroot, manifest, dependency) tuples, dependencies before the 
+        products that require them.  Each product appears once, along with
+        the server and the (already loaded) manifest it will be installed
+        from.
+        @param targets   a list of (product, version) tuples; a version of
+                           None selects the server's preferred version.
+        """
+        plan = []
+        chosen = {}           # product => (version, the target requiring it)
+        conflicts = []
+
+        for product, version in targets:
+            found = self.repos.findPackage(product, version, self.flavor)
+            if not found:
+                raise RuntimeError("%s %s: product not found on any server" %
+                                   (product, version or ""))
+            product, version, flavor, pkgroot = found
+
+            man = self.repos.repos[pkgroot].getManifest(product, version, 
+                                                        flavor)
+            for dep in man.getProducts():
+                if chosen.has_key(dep.product):
+                    have, requiredBy = chosen[dep.product]
+                    if have != dep.version:
+                        conflicts.append("%s: %s requires %s but %s requires %s"
+                                         % (dep.product, requiredBy, have,
+                                            product, dep.version))
+                    continue
+                chosen[dep.product] = (dep.version, product)
+                plan.append( (pkgroot, man, dep) )
+
+        if conflicts:
+            raise RuntimeError("Conflicting version requirements:\n  " +
+                               "\n  ".join(conflicts))
+
+        if self.verbose > 0:
+            print >> self.log, "Install plan for %d targets has %d products" \
+                % (len(targets), len(plan))
+        return plan
+
+    def _isInstalled(self, dep):
+        try:
+            return self.Eups.findProduct(dep.product, dep.version, 
+                                         flavor=self.flavor) is not None
+        except eups.ProductNotFound:
+            return False
+
+    def _getSetups(self, man, dep):
+        """return the setup commands for the products that precede a 
+        dependency in its manifest (i.e. that it may depend on).  As the
+        plan has no conflicting versions, these are the versions the 
+        plan installs.
+        """
+        setups = []
+        for prev in man.getProducts():
+            if prev.product == dep.product:
+                break
+            setups.append("setup %s %s" % (prev.product, prev.version))
+        return setups
+
+    def install(self, plan):
+        """install the products in a plan (as returned by plan()) that are 
+        not installed already.  Each product is installed directly from the
+        server and manifest recorded in the plan, so no manifest is read
+        again.  Return the number of products installed.
+        """
+        productRoot = eupsDistrib.findInstallableRoot(self.Eups)
+        if not productRoot:
+            raise RuntimeError("Unable to find a stack I can write to among $EUPS_PATH")
+
+        locks = eups.lock.takeLocks("eups fetch", productRoot, "exclusive",
+                                    verbose=self.verbose)
+        try:
+            ninstalled = 0
+            for pkgroot, man, dep in plan:
+                if self._isInstalled(dep):
+                    if self.verbose > 1:
+                        print >> self.log, "Product %s %s is already installed" \
+                            % (dep.product, dep.version)
+                    continue
+
+                if self.verbose > 0:
+                    print >> self.log, "Installing %s %s" % \
+                        (dep.product, dep.version)
+                self.repos.repos[pkgroot].installPackage(dep.distId, 
+                                   dep.product, dep.version, productRoot, 
+                                   dep.instDir, self._getSetups(man, dep))
+                self._ensureDeclared(pkgroot, dep, productRoot)
+                ninstalled += 1
+        finally:
+            eups.lock.giveLocks(locks, self.verbose)
+
+        return ninstalled
+
+    def _ensureDeclared(self, pkgroot, dep, productRoot):
+        """declare a newly installed product unless its build already did.
+        As with "eups distrib install", the table file is retrieved from 
+        the server the product was installed from.
+        """
+        if self._isInstalled(dep) or self.Eups.noaction:
+            return
+        installDir = os.path.join(productRoot, self.flavor, dep.instDir)
+        if not os.path.isdir(installDir):
+            raise RuntimeError("%s %s: install directory %s not found" %
+                               (dep.product, dep.version, installDir))
+
+        tablefile = None
+        if dep.tablefile and dep.tablefile != "none":
+            distServer = self.repos.repos[pkgroot].distServer
+            tablefile = distServer.getTableFile(dep.product, dep.version,
+                                                self.flavor)
+
+        self.Eups.declare(dep.product, dep.version, installDir,
+                          eupsPathDir=productRoot, tablefile=tablefile)
+
+    def run(self, targets):
+        """plan and install a list of targets; see plan()."""
+        return self.install(self.plan(targets))